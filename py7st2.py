@@ -1,100 +1,356 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import ccxt
-from datetime import datetime
-
-# Initialize ccxt Binance client
-binance = ccxt.binance()
-
-def price_format(val):
-    if isinstance(val, (int, float)):
-        if val > 0.1:
-            return '{:,.2f}'.format(val)
-        elif val > 0.01:
-            return '{:,.4f}'.format(val)
-        elif val > 0.0001:
-            return '{:,.6f}'.format(val)
-        elif val > 0.000001:
-            return '{:,.8f}'.format(val)
-        elif val > 0.00000001:
-            return '{:,.10f}'.format(val)
-        elif val > 0.0000000001:
-            return '{:,.12f}'.format(val)
-        else:
-            return '{:,.15f}'.format(val)
-    return "N/A"
+import heapq
+import os
+import orjson
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Number of symbols whose history is fetched concurrently
+MAX_WORKERS = 32
+# Candle interval and number of candles the EMAs are seeded from
+INTERVAL = '1d'
+HISTORY_LIMIT = 500
+# On-disk cache shared by every Streamlit process and surviving restarts
+CACHE_DIR = Path(__file__).parent / '.cache'
+# Latest result written by the background refresh and read on every page load
+RESULT_PATH = CACHE_DIR / 'result.parquet'
+# EMAs over closed candles, carried between refreshes so only new candles are fetched
+EMA_STATE_PATH = CACHE_DIR / 'ema_state.json'
+# Seconds between background refreshes
+REFRESH_INTERVAL = 600
+# Request weight the klines fetches may spend per minute: below Binance's 6000 per IP,
+# leaving room for the ticker, price and market calls
+KLINES_WEIGHT_PER_MINUTE = 5000
+
+@st.cache_resource  # One client per server process instead of one per script rerun
+def create_binance_client():
+    # Initialize ccxt Binance client (it decodes responses with orjson when installed)
+    client = ccxt.binance()
+    # Keep one pooled keep-alive connection per worker thread, and back off and retry
+    # when Binance briefly fails a request (Retry-After capped at 30s). Rate limits are
+    # not retried: retrying a 429 early is what earns a 418 IP ban, so ccxt raises at
+    # once and the next refresh picks it up.
+    # The last response is handed to ccxt so its usual error mapping still applies.
+    retry = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504],
+                  allowed_methods=['GET'], raise_on_status=False, retry_after_max=30)
+    client.session.mount('https://', HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS,
+                                                 max_retries=retry))
+    return client
+
+binance = create_binance_client()
+
+# Price thresholds (ascending) and the formatter used for each bucket between them
+PRICE_BINS = [0.0000000001, 0.00000001, 0.000001, 0.0001, 0.01, 0.1]
+PRICE_FORMATTERS = [f'{{:,.{decimals}f}}'.format for decimals in (15, 12, 10, 8, 6, 4, 2)]
+
+def price_format(values):
+    values = np.asarray(values, dtype=float)
+    # right=True keeps each threshold in the bucket below it, i.e. "val > threshold"
+    buckets = np.digitize(values, PRICE_BINS, right=True)
+    return [PRICE_FORMATTERS[bucket](val) if finite else "N/A"
+            for val, bucket, finite in zip(values.tolist(), buckets.tolist(), np.isfinite(values).tolist())]
+
+def percent_format(values):
+    return np.char.mod('%.2f%%', np.asarray(values, dtype=float))
+
+def utc_date():
+    return datetime.now(timezone.utc).date().isoformat()
+
+def write_atomically(path, write):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file first so readers never see a partial file
+    with tempfile.NamedTemporaryFile(dir=path.parent, delete=False) as f:
+        write(f)
+    os.replace(f.name, path)
+
+def write_json(path, value):
+    write_atomically(path, lambda f: f.write(orjson.dumps(value)))
+
+def read_json(path):
+    return orjson.loads(path.read_bytes())
+
+def cached_response(endpoint, key, fetch):
+    # Daily candles roll over at UTC midnight, so keying by the UTC date
+    # expires every entry exactly when a new candle opens.
+    # Responses are stored as JSON bytes: smaller and faster to load than pickles,
+    # and reading them back cannot execute code.
+    path = CACHE_DIR / endpoint / f"{key}_{utc_date()}.json"
+    if path.exists():
+        return read_json(path)
+    response = fetch()
+    write_json(path, response)
+    return response
+
+def prune_cache():
+    # Entries from previous UTC days can never be hit again
+    today = utc_date()
+    for path in CACHE_DIR.glob('*/*.json'):
+        if not path.stem.endswith(today):
+            path.unlink(missing_ok=True)
+
+def rank_usdt_pairs_by_volume(tickers, count):
+    usdt_tickers = (ticker for ticker in tickers.values() if ticker['symbol'].endswith('USDT'))
+    # Partial selection of the top `count` instead of sorting every pair
+    top_tickers = heapq.nlargest(count, usdt_tickers, key=lambda ticker: float(ticker.get('quoteVolume') or 0))
+    return [ticker['symbol'] for ticker in top_tickers]
 
-@st.cache_data(ttl=86400)  # Cache the data for 24 hours (86400 seconds)
 def get_top_500_usdt_pairs_by_volume():
     try:
-        tickers = binance.fetch_tickers()
-        tickers_df = pd.DataFrame(tickers).transpose()
-        tickers_df = tickers_df[tickers_df['symbol'].str.endswith('USDT')]
-        tickers_df['volume'] = pd.to_numeric(tickers_df['quoteVolume'], errors='coerce')
-        top_500_usdt_pairs = tickers_df.sort_values('volume', ascending=False).head(500)
-        return top_500_usdt_pairs['symbol'].tolist()
+        # Only the resulting symbols are cached, not the whole ticker payload
+        return cached_response('tickers', 'top500_usdt',
+                               lambda: rank_usdt_pairs_by_volume(binance.fetch_tickers(), 500))
     except Exception as e:
         print(f"Error fetching top USDT pairs: {e}")
         return []
 
-@st.cache_data(ttl=86400)  # Cache the historical data for 24 hours
-def get_historical_data(symbol, interval='1d', limit=500):
+def get_last_prices(symbols):
     try:
-        ohlcv = binance.fetch_ohlcv(symbol, timeframe=interval, limit=limit)
-        df = pd.DataFrame(ohlcv, columns=['open_time', 'open', 'high', 'low', 'close', 'volume'])
-        df['close'] = pd.to_numeric(df['close'])
-        df['time'] = pd.to_datetime(df['open_time'], unit='ms')
-        return df
+        # One request returns the latest trade price of every symbol
+        last_prices = binance.fetch_last_prices(symbols)
+        return {symbol: ticker['price'] for symbol, ticker in last_prices.items() if ticker['price'] is not None}
+    except Exception as e:
+        print(f"Error fetching last prices: {e}")
+        return {}
+
+# Binance's weight for one klines request, by limit
+def klines_weight(limit):
+    return 1 if limit < 100 else 2 if limit < 500 else 5 if limit <= 1000 else 10
+
+# Token bucket shared by the worker threads. ccxt's own throttle is not thread-safe:
+# every worker reads the same last-request time and they all fire together.
+weight_bucket = {'tokens': KLINES_WEIGHT_PER_MINUTE, 'updated': time.monotonic()}
+weight_bucket_lock = threading.Lock()
+
+def take_request_weight(weight):
+    while True:
+        with weight_bucket_lock:
+            now = time.monotonic()
+            tokens = min(KLINES_WEIGHT_PER_MINUTE,
+                         weight_bucket['tokens'] + (now - weight_bucket['updated']) * KLINES_WEIGHT_PER_MINUTE / 60)
+            weight_bucket['updated'] = now
+            if tokens >= weight:
+                weight_bucket['tokens'] = tokens - weight
+                return
+            weight_bucket['tokens'] = tokens
+            wait = (weight - tokens) * 60 / KLINES_WEIGHT_PER_MINUTE
+        time.sleep(wait)
+
+def fetch_ohlcv(symbol, interval, limit, since):
+    take_request_weight(klines_weight(limit))
+    return binance.fetch_ohlcv(symbol, timeframe=interval, since=since, limit=limit)
+
+def get_historical_data(symbol, interval='1d', limit=500, since=None):
+    try:
+        ohlcv = cached_response('klines', f"{symbol.replace('/', '-')}_{interval}_{limit}_{since}",
+                                lambda: fetch_ohlcv(symbol, interval, limit, since))
+        # Rows are [open_time, open, high, low, close, volume]
+        return np.asarray(ohlcv, dtype=float).reshape(-1, 6)
     except Exception as e:
         print(f"Error fetching historical data for {symbol}: {e}")
-        return pd.DataFrame()
-
-def calculate_ema_and_breakout(df, period=34):
-    df = df.copy()
-    df['EMA_34'] = df['close'].ewm(span=period, adjust=False).mean()
-    df = df.dropna(subset=['close', 'EMA_34'])
-    df['difference_34'] = (df['close'] - df['EMA_34']) / df['EMA_34'] * 100
-    df['difference_34'] = df['difference_34'].apply(lambda x: f"{x:.2f}%")
-    df['status_34'] = df.apply(lambda row: 'breakup' if row['close'] > row['EMA_34'] else 'breakdown', axis=1)
-    return df
-
-def calculate_ema102_and_breakout(df, period=102):
-    df = df.copy()
-    df['EMA_102'] = df['close'].ewm(span=period, adjust=False).mean()
-    df = df.dropna(subset=['close', 'EMA_102'])
-    df['difference_102'] = (df['close'] - df['EMA_102']) / df['EMA_102'] * 100
-    df['difference_102'] = df['difference_102'].apply(lambda x: f"{x:.2f}%")
-    df['status_102'] = df.apply(lambda row: 'breakup' if row['close'] > row['EMA_102'] else 'breakdown', axis=1)
-    return df
-
-@st.cache_data(ttl=86400)  # Cache the processed data for 24 hours
+        return np.empty((0, 6))
+
+# {symbol: [open time of the last closed candle, EMA 34, EMA 102]}
+def load_ema_state():
+    if not EMA_STATE_PATH.exists():
+        return {}
+    return read_json(EMA_STATE_PATH)
+
+def save_ema_state(ema_state):
+    write_json(EMA_STATE_PATH, ema_state)
+
+# Only the latest EMA value is ever displayed, so evaluate it in closed form:
+# continuing ewm(span=period, adjust=False) from seed over closes x_0..x_(n-1)
+# gives (1-alpha)^n * seed + sum of alpha*(1-alpha)^(n-1-i) * x_i.
+def ema_weights(length, period):
+    alpha = 2 / (period + 1)
+    return alpha * (1 - alpha) ** np.arange(length - 1, -1, -1)
+
+EMA_PERIODS = (34, 102)
+EMA_ALPHAS = 2 / (np.array(EMA_PERIODS) + 1)
+# Built once, one column per period so both EMAs come out of a single pass over the
+# closes. float32 is plenty for a daily EMA and halves the memory the product streams.
+EMA_WEIGHTS = np.column_stack([ema_weights(HISTORY_LIMIT, period) for period in EMA_PERIODS]).astype(np.float32)
+
+def breakout_status(close, ema):
+    return np.where(close > ema, 'breakup', 'breakdown')
+
+def percent_difference(close, ema):
+    return (close - ema) / ema * 100
+
+# Formatting is only needed for the rows that are actually displayed
+def format_for_display(df):
+    return df.assign(**{
+        'CLOSE': price_format(df['CLOSE']),
+        '%DIFF34': percent_format(df['%DIFF34']),
+        'LINE102': price_format(df['LINE102']),
+        '%DIFF102': percent_format(df['%DIFF102']),
+        'UPDATED': pd.to_datetime(df['UPDATED'], unit='ms', utc=True).dt.strftime('%H:%M UTC'),
+    })
+
 def fetch_and_process_data():
+    prune_cache()
     top_usdt_pairs = get_top_500_usdt_pairs_by_volume()
-    coins_data = []
 
-    for symbol in top_usdt_pairs:
-        df = get_historical_data(symbol, limit=500)
-        if df.empty:
+    try:
+        # Load markets once up front instead of racing to do it in every worker thread
+        binance.load_markets()
+    except Exception as e:
+        print(f"Error loading markets: {e}")
+
+    interval_ms = binance.parse_timeframe(INTERVAL) * 1000
+    now = binance.milliseconds()
+    open_time = now // interval_ms * interval_ms  # of the candle still forming
+    ema_state = load_ema_state()
+    last_prices = get_last_prices(top_usdt_pairs)
+
+    # Returns (state, closed candle times, closed candle closes, open candle close) or None
+    def fetch(symbol):
+        state = ema_state.get(symbol)
+        price = last_prices.get(symbol)
+        if state is not None and state[0] + interval_ms == open_time and price is not None:
+            # Nothing closed since the saved EMAs, so the bulk last price is all that is needed
+            return state, np.empty(0), np.empty(0), price
+
+        # Continue from the saved EMAs unless more candles closed since than one request returns
+        if state is not None and now - state[0] < HISTORY_LIMIT * interval_ms:
+            candles = get_historical_data(symbol, INTERVAL, HISTORY_LIMIT, since=state[0] + interval_ms)
+        else:
+            state = None
+            candles = get_historical_data(symbol, INTERVAL, HISTORY_LIMIT)
+        if candles.size == 0:
+            return None
+
+        closed = candles[candles[:, 0] < open_time]
+        # The bulk last price is fresher than a (possibly cached) klines close of the open candle
+        if price is None and len(closed) < len(candles):
+            price = candles[-1, 4]
+        return state, closed[:, 0], closed[:, 4], np.nan if price is None else price
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        fetched = list(executor.map(fetch, top_usdt_pairs))
+
+    # Per symbol: the EMAs to continue from, the closed closes after them (right-aligned,
+    # zero padding adds nothing to the weighted sum) and the close of the still-open candle
+    n = len(top_usdt_pairs)
+    symbols = np.empty(n, dtype=object)
+    seeds = np.empty((n, 2))
+    tails = np.zeros((n, HISTORY_LIMIT), dtype=np.float32)
+    tail_sizes = np.empty(n, dtype=int)
+    open_close = np.full(n, np.nan)
+    last_closed_time = np.full(n, np.nan)
+    close = np.empty(n)
+    count = 0
+
+    for symbol, candles in zip(top_usdt_pairs, fetched):
+        if candles is None:
             continue
-        df_ema34 = calculate_ema_and_breakout(df)
-        df_ema102 = calculate_ema102_and_breakout(df)
-
-        if not df_ema34.empty and not df_ema102.empty:
-            latest_34 = df_ema34.iloc[-1]
-            latest_102 = df_ema102.iloc[-1]
-            if pd.notna(latest_34['EMA_34']) and pd.notna(latest_102['EMA_102']):
-                coins_data.append([symbol, latest_34['close'], latest_34['status_34'], latest_34['difference_34'],
-                                   latest_102['EMA_102'], latest_102['status_102'], latest_102['difference_102']])
-
-    result_df = pd.DataFrame(coins_data, columns=['COIN', 'CLOSE', 'STATUS34', '%DIFF34', 
-                                                  'LINE102', 'STATUS102', '%DIFF102'])
-    
-    # Apply price formatting
-    result_df['CLOSE'] = result_df['CLOSE'].apply(price_format)
-    result_df['LINE102'] = result_df['LINE102'].apply(price_format)
-    
+        state, times, history, open_close[count] = candles
+        close[count] = history[-1] if np.isnan(open_close[count]) else open_close[count]
+
+        if state is not None:
+            seeds[count] = state[1:]
+            last_closed_time[count] = times[-1] if times.size else state[0]
+        elif history.size:
+            seeds[count] = history[0]
+            last_closed_time[count] = times[-1]
+            history = history[1:]
+        else:
+            # Listed today: the open candle is the whole history
+            seeds[count] = open_close[count]
+            open_close[count] = np.nan
+        tails[count, HISTORY_LIMIT - history.size:] = history
+        tail_sizes[count] = history.size
+        symbols[count] = symbol
+        count += 1
+
+    # EMAs over the closed candles for all symbols from one matrix product,
+    # then a single recurrence step for the open candle
+    closed_ema = (1 - EMA_ALPHAS) ** tail_sizes[:count, None] * seeds[:count] + tails[:count] @ EMA_WEIGHTS
+    open_close = open_close[:count, None]
+    ema = np.where(np.isnan(open_close), closed_ema, closed_ema + EMA_ALPHAS * (open_close - closed_ema))
+
+    valid = pd.notna(ema).all(axis=1)
+    persist = valid & pd.notna(last_closed_time[:count])
+    ema_state.update({symbol: (int(closed_time), *emas.tolist()) for symbol, closed_time, emas in
+                      zip(symbols[:count][persist], last_closed_time[:count][persist], closed_ema[persist])})
+    save_ema_state(ema_state)
+
+    symbols, close, (ema_34, ema_102) = symbols[:count][valid], close[:count][valid], ema[valid].T
+
+    result_df = pd.DataFrame({
+        'COIN': symbols,
+        'CLOSE': close,
+        'STATUS34': breakout_status(close, ema_34),
+        '%DIFF34': percent_difference(close, ema_34),
+        'LINE102': ema_102,
+        'STATUS102': breakout_status(close, ema_102),
+        '%DIFF102': percent_difference(close, ema_102),
+        'UPDATED': now,
+    })
+
+    # Coins whose fetch failed this time keep their last good row, but only while it is
+    # from the same daily candle; UPDATED shows it is older than the rest
+    failed = [symbol for symbol, candles in zip(top_usdt_pairs, fetched) if candles is None]
+    if failed and RESULT_PATH.exists():
+        previous_df = pd.read_parquet(RESULT_PATH)
+        carried = previous_df['COIN'].isin(failed) & (previous_df.get('UPDATED', 0) >= open_time)
+        result_df = pd.concat([result_df, previous_df[carried]], ignore_index=True)
+
     return result_df
 
+def refresh_result_file():
+    result_df = fetch_and_process_data()
+    # An outage yields no rows; keep serving the last good result instead of blanking the page
+    if result_df.empty:
+        print("Error refreshing data: no data fetched, keeping the previous result")
+        return
+    write_atomically(RESULT_PATH, result_df.to_parquet)
+
+def refresh_periodically(first_refresh_done):
+    while True:
+        try:
+            refresh_result_file()
+        except Exception as e:
+            print(f"Error refreshing data: {e}")
+        first_refresh_done.set()
+        time.sleep(REFRESH_INTERVAL)
+
+REFRESH_THREAD_NAME = 'refresh_periodically'
+
+@st.cache_resource  # One refresh thread per server process, not per rerun or session
+def start_background_refresh():
+    # Clearing the resource cache runs this again; reuse the thread that is still running
+    for thread in threading.enumerate():
+        if thread.name == REFRESH_THREAD_NAME:
+            return thread.first_refresh_done
+    first_refresh_done = threading.Event()
+    thread = threading.Thread(target=refresh_periodically, args=(first_refresh_done,),
+                              name=REFRESH_THREAD_NAME, daemon=True)
+    thread.first_refresh_done = first_refresh_done
+    thread.start()
+    return first_refresh_done
+
+# cache_resource hands every session the same frame without pickling or hashing it,
+# so callers must not modify it in place. The file's mtime is the cache key, and the
+# filter, sort and formatting run once per refresh instead of on every rerun.
+@st.cache_resource(max_entries=1)
+def load_breakup_table(modified_time_ns):
+    result_df = pd.read_parquet(RESULT_PATH)
+    if result_df.empty:
+        return None
+    breakup_df = result_df[result_df['STATUS34'] == 'breakup']
+    sorted_breakup_df = breakup_df.sort_values(by='%DIFF34')
+    return format_for_display(sorted_breakup_df)
+
 def main():
     st.title("EMA Breakup Data")
 
@@ -115,15 +371,16 @@ def main():
     st.write("**This data is from Binance using `ccxt`, filtered by top 500 coins by volume and shows only USDT pairs.**")
     st.write("**It provides a view of whether the price is above or below EMA of 34 days and EMA of 102 days, along with the percentage difference.**")
 
-    # Display data with spinner
-    with st.spinner("Fetching and processing data..."):
-        result_df = fetch_and_process_data()
+    # Data is fetched off the request thread; only the very first load has to wait for it
+    first_refresh_done = start_background_refresh()
+    if not RESULT_PATH.exists():
+        with st.spinner("Fetching and processing data..."):
+            first_refresh_done.wait()
 
-    if result_df is not None and not result_df.empty:
-        breakup_df = result_df[result_df['STATUS34'] == 'breakup']
-        sorted_breakup_df = breakup_df.sort_values(by='%DIFF34')
+    breakup_table = load_breakup_table(RESULT_PATH.stat().st_mtime_ns) if RESULT_PATH.exists() else None
 
-        st.dataframe(sorted_breakup_df)
+    if breakup_table is not None:
+        st.dataframe(breakup_table)
     else:
         st.write("No data available. Please try again later.")
 